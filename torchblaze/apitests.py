@@ -1,13 +1,7 @@
 import importlib
 import os
-from flask import url_for
 import sys
-import requests
 import json
-# Setting the System Path to current directory
-
-curr_dir = os.getcwd()
-sys.path.append(curr_dir)
 
 
 
@@ -21,9 +15,9 @@ def has_no_empty_params(rule):
         Bool: True if the route doesn't contain any empty parameters, otherwise false.
     """
     
-    defaults = (rule.defaults if rule.defaults is not None else ())
-    arguments = (rule.arguments if rule.arguments is not None else ())
-    return len(defaults) >= len(arguments)
+    defaults = rule.defaults
+    arguments = rule.arguments
+    return (0 if defaults is None else len(defaults)) >= (0 if arguments is None else len(arguments))
 
 
 def get_routes():
@@ -33,67 +27,107 @@ def get_routes():
         None
 
     Returns:
-        list: returns the list of routes defined in app.py
+        generator: yields the routes defined in app.py one at a time
     """
     
-    # Loading the app.py file as a module using library importlib
+    # Setting the System Path to current directory, so that app.py can be imported
+    curr_dir = os.getcwd()
+    if curr_dir not in sys.path:
+        sys.path.insert(0, curr_dir)
 
     from app import app
-    routes = []
     for rule in app.url_map.iter_rules():
         # Checking whether the rule has any empty params
 
         if has_no_empty_params(rule):
-            # The list contains the tuple which comprises of route method,route path,route end point
+            # Each route is a tuple which comprises of route method,route path,route end point
+
+            yield (rule.methods,str(rule),rule.endpoint)
+
 
-            routes.append((rule.methods,str(rule),rule.endpoint))
-    return routes
+def _check_route(session,route,baseurl,data):
+    """Sends the requests for a single route and gives back the outcome of the test
 
+    Arguments:
+        input takes the requests session, the route tuple returned by get_routes, the baseurl of the api and the test cases loaded from tests.json
 
-def tests(routes,baseurl):
+    Returns:
+        tuple: the message to be printed for the route, None if the route was skipped
+    """
+    methods,path,endpoint=route
+
+    # GET Method Testing
+    if 'GET' in methods:
+        response=session.get(baseurl+str(path))
+        status_code_get=response.status_code
+        if(status_code_get==200):
+            return ("route",str(path),"get successful")
+        return (path,"failed with return status_code",status_code_get)
+    # POST Method Implemntation
+    elif 'POST' in methods:
+        endpoint=str(endpoint)
+        if endpoint=='makeprediction':
+            return None
+        end_test_data=data[endpoint]
+        for test in end_test_data:
+            response=session.post(baseurl+str(path),json=test)
+        status_code_post=response.status_code
+        if(status_code_post==200):
+            return ("route",str(path),"post successful")
+        return (path,"failed with return status_code",status_code_post)
+    return None
+
+
+def tests(routes,baseurl,max_workers=1):
     """It sends the request to the routes by taking test cases from tests.json"
 
     Arguments:
-        input takes list of routes and the baseurl of the api
+        input takes an iterable of routes, the baseurl of the api and the number of routes to be tested concurrently (1 by default, since POST tests on stateful endpoints can interfere with each other)
 
     Returns:
         None
     """
+    # Importing requests here so that get_routes doesn't pay for its import time
+    import requests
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
     # Loading tests.json file
     curr_dir=os.getcwd()
     f = os.path.join(curr_dir, "tests.json")
     with open(f, "r") as jsonfile:
         data=json.load(jsonfile)
         #print(data)
-    for i in routes:
-        
-        # GET Method Testing
-        if 'GET' in i[0]:
-            #print("get")
-            #print(baseurl)
-            response=requests.get(baseurl+str(i[1]))
-            status_code_get=response.status_code
-            if(status_code_get==200):
-                print("route",str(i[1]),"get successful")
-            else:
-                print(i[1],"failed with return status_code",status_code_get)
-        # POST Method Implemntation
-        elif 'POST' in i[0]:
-            endpoint=str(i[2])
-            if endpoint=='makeprediction':
-                continue
-            end_test_data=data[endpoint]
-            for test in end_test_data:
-                response=requests.post(baseurl+str(i[1]),json=test)
-            status_code_post=response.status_code
-            if(status_code_post==200):
-                print("route",str(i[1]),"post successful")
-            else:
-                print(i[1],"failed with return status_code",status_code_post)
+
+    # A session keeps the connections alive across routes, sessions aren't thread-safe so each worker gets its own
+    local=threading.local()
+    sessions=[]
+
+    def run_test(route):
+        if not hasattr(local,"session"):
+            local.session=requests.Session()
+            sessions.append(local.session)
+        return _check_route(local.session,route,baseurl,data)
+
+    try:
+        if max_workers<=1:
+            results=map(run_test,routes)
+            for result in results:
+                if result is not None:
+                    print(*result)
+        else:
+            # The routes are tested concurrently, results are printed in the order of the routes
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for result in executor.map(run_test,routes):
+                    if result is not None:
+                        print(*result)
+    finally:
+        for session in sessions:
+            session.close()
 
 
 
 
 
 if __name__ == '__main__':
-    get_routes()
+    list(get_routes())
@@ -1,6 +1,8 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint_sequential
+import inspect
 
 # creating some custom exceptions
 class ParamsTooLargeException(Exception):
@@ -56,9 +58,7 @@ def check_cuda(params):
     Returns:
         None: Throws an exception if the training device is not CUDA-enabled.
     """ 
-    try:
-        assert params.device.type == "cuda"  # asserts if the tensor is on a cuda device
-    except AssertionError:
+    if params.device.type != "cuda":  # checks if the tensor is on a cuda device
         raise DeviceNotCudaException("Training device is not of the type CUDA.")
 
 
@@ -74,9 +74,7 @@ def check_nan(name, params):
     Returns:
         None- Throws an exception in case any parameter is a NaN value.
     """
-    try:
-        assert not params.isnan().any()
-    except AssertionError:
+    if params.isnan().any():
         raise NaNParamsException(f"\nNaN values found in the layer: {name}")
 
 
@@ -92,14 +90,36 @@ def check_infinite(name, params):
     Returns:
         None- Throws an exception in case any parameter is a Inf value.
     """
-    try:
-        assert not params.isinf().any()
-    except AssertionError:
+    if params.isinf().any():
         raise InfParamsException(
             f"\nInfinite values found in the layer: {name}")
 
 
 
+# method to check if input param has nan or infinite values
+def check_valid(name, params, test_nan=True, test_infinite=True):
+    """Tests for the presence of NaN or infinite values in the given tensor of model parameter with a single pass over the tensor.
+
+    Arguments:
+        name::str- Name of the parameter
+        params::torch.Tensor- Trainable named parameters associated with a layer
+        test_nan::bool- default=True, Throws an exception in case any parameter is a NaN value
+        test_infinite::bool- default=True, Throws an exception in case any parameter is a Inf value
+
+    Returns:
+        None- Throws an exception in case any parameter is a NaN or Inf value.
+    """
+    if torch.isfinite(params).all():
+        return
+
+    # NaN and Inf values are told apart only once the tensor is known to be invalid
+    if test_nan:
+        check_nan(name, params)
+    if test_infinite:
+        check_infinite(name, params)
+
+
+
 # method to assert all absolute parameter values < threshold
 def check_smaller(name, params, upper_limit=0):
     """Tests if the absolute value of any parameter exceeds a certain threshold.
@@ -112,9 +132,9 @@ def check_smaller(name, params, upper_limit=0):
     Returns:
         None- Throws an exception in case any parameter exceeds the upper_limit threshold value.
     """
-    try:
-        assert params.abs().less(upper_limit).any()
-    except AssertionError:
+    # max |p| is the larger magnitude of the signed extremes, so no |params| tensor is allocated
+    params_min, params_max = torch.aminmax(params)
+    if torch.maximum(params_min.abs(), params_max.abs()) >= upper_limit:
         raise ParamsTooLargeException(
             f"\nCertain parameters in layer '{name}' found to be greater than the threshold value = {upper_limit}.")
 
@@ -132,9 +152,9 @@ def check_greater(name, params, lower_limit=0):
     Returns:
         None- Throws an exception in case any parameter is a NaN value.
     """
-    try:
-        assert params.abs().greater(lower_limit).any()
-    except AssertionError:
+    # min |p| can't be told from the signed extremes when the parameters change sign, so it is
+    # reduced directly, the -inf norm takes the absolute values inside the reduction kernel
+    if torch.linalg.vector_norm(params, float("-inf")) <= lower_limit:
         raise ParamsTooSmallException(
             f"\nCertain parameters in layer '{name}' found to be smaller than the threshold value = {lower_limit}.")
 
@@ -156,20 +176,128 @@ def check_gradient_smaller(name, params, grad_limit=1e3):
     """
     grads = params.grad  # gets the gradients associated with model parameter
     
-    # asserting if the gradients were pre-initialized 
-    try:
-        assert not (grads == None)
-    except AssertionError:
+    # checking if the gradients were pre-initialized 
+    if grads is None:
         raise GradientsUninitializedException("\nModel gradients not initialized. Kindly run loss.backwards() to initialize gradients first.")
 
-    # asserting if the absolute gradients are less than theshold
-    try:
-        assert not grads.abs().greater(grad_limit).any()
-    except AssertionError:
+    # checking if the absolute gradients are less than theshold
+    if torch.linalg.vector_norm(grads, float("inf")) > grad_limit:
         raise GradientAboveThresholdException(f"\nGradients (absolute) for certain parameters in layer '{name}' found to be greater than the threshold grad_limit value = {grad_limit}.")
 
 
 
+# method to stack per-layer scalars that may live on different devices
+def _stack_on(scalars, device):
+    """Stacks the given per-layer scalars into a single tensor on the given device.
+
+    Arguments:
+        scalars::list- Per-layer scalar tensors, which can be on different devices if the model is spread over several.
+        device::torch.device- The device to gather the scalars on.
+
+    Returns:
+        stacked::torch.Tensor- A 1D tensor with one value per layer.
+    """
+    return torch.stack([scalar.to(device) for scalar in scalars])
+
+
+
+# method to run the NaN/Inf and threshold checks on all the layers in a single pass
+def _batched_flags(params_list, lower_limit=0, upper_limit=0, test_nan=True,
+                   test_infinite=True, test_smaller=True, test_greater=True):
+    """Computes the per-layer flags of the NaN/Inf and threshold checks for every layer of the model.
+
+    Arguments:
+        params_list::list- The trainable parameter tensors of the model.
+        lower_limit::float- The threshold value every parameter should be greater than in terms of its absolute value.
+        upper_limit::float- The threshold value every parameter should be smaller than in terms of its absolute value.
+        test_nan, test_infinite, test_smaller, test_greater::bool- Flags to enable the respective checks, the
+        reductions of the disabled checks are skipped.
+
+    Returns:
+        flags::torch.Tensor- A (3, len(params_list)) boolean tensor on the device of the first parameter, whose rows flag
+        the layers with non-finite values, too large values and too small values respectively.
+    """
+    # the flags are gathered on one device, the parameters of a model can be spread over several
+    device = params_list[0].device
+    not_flagged = torch.zeros(len(params_list), dtype=torch.bool, device=device)
+    non_finite = too_large = too_small = not_flagged
+
+    # per-layer reductions, launched over the whole parameter list at once, cheapest first
+    if test_nan or test_infinite:
+        non_finite = _stack_on([torch.isfinite(params).all() for params in params_list], device).logical_not()
+    # the inf/-inf norms give max |p| and min |p| without materializing |params|
+    if test_smaller:
+        too_large = _stack_on(torch._foreach_norm(params_list, float("inf")), device).greater_equal(upper_limit)
+    if test_greater:
+        too_small = _stack_on([torch.linalg.vector_norm(params, float("-inf"))
+                               for params in params_list], device).less_equal(lower_limit)
+
+    # one row of per-layer flags for every check, so they can be brought back to the CPU together
+    return torch.stack([non_finite, too_large, too_small])
+
+
+
+# method to raise the exceptions flagged by _batched_flags
+def _raise_on_flags(model_params, flags, lower_limit=0, upper_limit=0, test_nan=True,
+                    test_infinite=True, test_smaller=True, test_greater=True):
+    """Raises the matching exception for the first layer flagged by _batched_flags.
+
+    Arguments:
+        model_params::list- List of all the named parameters in the model, as returned by get_params.
+        flags::list- The flags returned by _batched_flags, as a nested list on the CPU.
+        lower_limit, upper_limit::float- The threshold values the flags were computed with.
+        test_nan, test_infinite, test_smaller, test_greater::bool- Flags to enable the respective checks.
+
+    Returns:
+        None- Throws the matching exception for the first layer failing any of the enabled checks.
+    """
+    non_finite, too_large, too_small = flags
+
+    # nothing is flagged on the passing path, there is no need to go through the layers then
+    if not (any(non_finite) or any(too_large) or any(too_small)):
+        return
+
+    # the individual checks are only re-run on failure to raise the matching exception
+    for (name, params), nan_or_inf, large, small in zip(model_params, non_finite, too_large, too_small):
+        if nan_or_inf:
+            check_valid(name, params, test_nan=test_nan, test_infinite=test_infinite)
+            # with both checks on, check_valid has raised; otherwise the thresholds still have to be tested
+        if large and test_smaller:
+            check_smaller(name, params, upper_limit=upper_limit)
+        if small and test_greater:
+            check_greater(name, params, lower_limit=lower_limit)
+
+
+
+# method to check the gradients of all the layers in a single pass
+def _batched_gradient_check(model_params, grad_limit=1e3):
+    """Tests if the absolute gradient value for any parameter of the model exceeds a certain threshold, with a single device sync.
+
+    Arguments:
+        model_params::list- List of all the named parameters in the model, as returned by get_params.
+        grad_limit::float- A threshold value, such that, |params.grad| < grad_limit
+
+    Returns:
+        None- Throws the matching exception for the first layer failing the check, see check_gradient_smaller.
+    """
+    for name, params in model_params:
+        if params.grad is None:
+            check_gradient_smaller(name, params, grad_limit=grad_limit)  # raises GradientsUninitializedException
+
+    if not model_params:
+        return
+
+    # the max-norm of every gradient is computed at once, like torch.nn.utils.clip_grad_norm_ does
+    grads = [params.grad for _, params in model_params]
+    too_large = _stack_on(torch._foreach_norm(grads, float("inf")), grads[0].device).greater(grad_limit).tolist()
+
+    # the check is only re-run on failure to raise the matching exception
+    for (name, params), large in zip(model_params, too_large):
+        if large:
+            check_gradient_smaller(name, params, grad_limit=grad_limit)
+
+
+
 # method to check if parameters are changing
 def check_params_changing(params_list_old, params_list_new):
     """Tests if the parameters in the model/certain layer are changing after a training cycle.
@@ -182,25 +310,75 @@ def check_params_changing(params_list_old, params_list_new):
     Returns:
         None- Throws an exception in case the parameters are not changing 
     """
-    try:  # if all model parameters are equal, raise exception
-        for old, new in zip(params_list_old, params_list_new):
-            _, params_old = old
-            _, params_new = new
-            assert params_old.equal(params_new) # true if both param tensors are equal
-        raise ParamsNotChangingException(f"\nModel parameters found to be NOT changing post training.")
-
-    except AssertionError:
-        print("Test for parameter change after training passed successfully.") 
+    for old, new in zip(params_list_old, params_list_new):
+        _, params_old = old
+        _, params_new = new
+        if not params_old.equal(params_new): # true if the param tensors differ
+            print("Test for parameter change after training passed successfully.")
+            return
+
+    # if all model parameters are equal, raise exception
+    raise ParamsNotChangingException(f"\nModel parameters found to be NOT changing post training.")
         
 
 
+# method to move a batch of data to the device of the model
+def _to_device(tensor, device):
+    """Moves the given tensor to the device, going through pinned memory when copying from the CPU to a GPU.
+
+    Arguments:
+        tensor- A batch of data features or labels, anything other than a torch.Tensor is returned unchanged
+        device::torch.device- The device the model is on
+
+    Returns:
+        tensor- The tensor on the given device.
+    """
+    if not isinstance(tensor, torch.Tensor) or tensor.device == device:
+        return tensor
+    if tensor.device.type == "cpu" and device.type == "cuda":
+        return tensor.pin_memory().to(device, non_blocking=True)
+
+    # a non-blocking copy to the CPU could be read before it lands, so the other copies are synchronous
+    return tensor.to(device)
+
+
+
+# use_reentrant is only accepted by checkpoint_sequential from PyTorch 2.0 onwards
+_CHECKPOINT_KWARGS = {}
+if "use_reentrant" in inspect.signature(checkpoint_sequential).parameters:
+    _CHECKPOINT_KWARGS["use_reentrant"] = False
+
+
+# method to compute the loss of the model on a batch, compiled by model_test if use_compile=True
+def _forward_loss(model, loss_fn, batch_x, batch_y, checkpoint_segments=0):
+    """Runs the forward pass of the model and evaluates the loss function on its output.
+
+    Arguments:
+        model::nn.Module- The model that is being tested.
+        loss_fn- Loss function to be used for model evaluation.
+        batch_x::torch.Tensor- A single batch of data features
+        batch_y::torch.Tensor- A single batch of data labels
+        checkpoint_segments::int- default=0, Number of gradient checkpointing segments for an nn.Sequential model, 0 disables checkpointing.
+
+    Returns:
+        loss::torch.Tensor- The loss of the model on the batch.
+    """
+    if checkpoint_segments:
+        output = checkpoint_sequential(model, checkpoint_segments, batch_x, **_CHECKPOINT_KWARGS)
+    else:
+        output = model(batch_x)
+    return loss_fn(output, batch_y)
+
+
+
 # automated test that combines all the model unit tests
 def model_test(model, batch_x, batch_y, optim_fn,
                loss_fn=torch.nn.CrossEntropyLoss(), epochs=10, 
-               test_gradient_smaller=True, test_greater=True,
+               test_gradient_smaller=True, test_greater=False,
                test_smaller=True, test_infinite=True, test_nan=True,
                test_cuda=False, test_params_changing=False, 
-               upper_limit=1e1, lower_limit=1e-2, grad_limit=1e4):
+               upper_limit=1e1, lower_limit=1e-2, grad_limit=1e4,
+               use_compile=False, grad_checkpointing=False):
     """Executes a suite of tests on the ML model.
     Set <test_name> = False if you want to exclude a certain test from the test suite.
 
@@ -217,7 +395,7 @@ def model_test(model, batch_x, batch_y, optim_fn,
 
         test_gradient_smaller::bool- default=True, Asserts if gradients exceed a certain threshold  
 
-        test_greater::bool- default=True, Asserts if all parameters > threshold limit
+        test_greater::bool- default=False, Asserts if all parameters > threshold limit (freshly initialized layers usually hold parameters close to 0, so enable it with a lower_limit suited to the model)
 
         test_smaller::bool- default=True, Asserts if all parameters < threshold limit
 
@@ -229,48 +407,118 @@ def model_test(model, batch_x, batch_y, optim_fn,
 
         test_cuda::bool- Default=False, Asserts that the model is training on a cuda-enabled GPU
 
-        upper_limit::float- default=1e2, Absolute value of all parameters should be smaller than this threshold value
+        upper_limit::float- default=1e1, Absolute value of all parameters should be smaller than this threshold value
 
         lower_limit::float- default=1e-2, Absolute value of all parameters should be greater than this threshold value
 
         grad_limit::float- default=1e4, Absolute value of all gradients should be smaller than this threshold value
+
+        use_compile::bool- default=False, Compiles the forward pass and loss computation with torch.compile (requires PyTorch 2.0+)
+
+        grad_checkpointing::bool- default=False, Recomputes activations during the backward pass instead of storing them, for nn.Sequential and HuggingFace-style models
     """
     model.train() # putting the model in training mode
 
-    model_params_old = get_params(model) # getting list of model parameters PRE training epoch
+    # getting list of model parameters, the tensors are updated in place so the list is reused across epochs
+    model_params = get_params(model)
     
     if test_cuda: # needs to be checked only once
-        check_cuda(model_params_old[0][1])
+        check_cuda(model_params[0][1])
 
-    # running training for 'epochs' number of epochs
-    for epoch in range(epochs): 
-        optim_fn.zero_grad()
-        output = model(batch_x)
-        loss = loss_fn(output, batch_y)
-        loss.backward()
-        optim_fn.step()
-
-        model_params = get_params(model) # getting list of model parameters POST training epoch
-
-        # tests will be performed on the basis of the flag value passed in function call
-        for name, params in model_params: 
-            if test_greater==True:
-                check_greater(name, params, lower_limit=lower_limit)
-            if test_smaller==True:
-                check_smaller(name, params, upper_limit=upper_limit)
-            if test_gradient_smaller==True:
-                check_gradient_smaller(name, params, grad_limit=grad_limit)
-            if test_nan==True:
-                check_nan(name, params)
-            if test_infinite==True:
-                check_infinite(name, params)
+    # values of the model parameters PRE training, copied since the tensors are updated in place
+    if test_params_changing==True:
+        model_params_old = [(name, params.detach().clone()) for name, params in model_params]
+
+    params_list = [params for _, params in model_params]
+
+    # the same batch is used in every epoch, so it is moved to the device of the model only once
+    if params_list:
+        batch_x = _to_device(batch_x, params_list[0].device)
+        batch_y = _to_device(batch_y, params_list[0].device)
+    validate = (test_nan or test_infinite or test_smaller or test_greater) and len(params_list) > 0
+    flag_limits = dict(lower_limit=lower_limit, upper_limit=upper_limit)
+    flag_tests = dict(test_nan=test_nan, test_infinite=test_infinite,
+                      test_smaller=test_smaller, test_greater=test_greater)
+
+    # on a GPU the parameter checks run on a side stream, overlapped with the next epoch, and
+    # their flags are copied back asynchronously into a pinned host buffer allocated once.
+    # a model spread over several devices is checked inline, a single stream can't cover all of them
+    validate_stream = None
+    single_device = all(params.device == params_list[0].device for params in params_list)
+    if validate and single_device and params_list[0].is_cuda:
+        validate_stream = torch.cuda.Stream(device=params_list[0].device)  # not necessarily the current device
+        host_flags = torch.empty((3, len(params_list)), dtype=torch.bool, pin_memory=True)
+    pending_flags = None  # flags of the previous epoch, still being copied on validate_stream
+
+    # trading compute for activation memory, so larger batches fit in memory
+    # the settings of HuggingFace-style models are restored once the tests are done
+    checkpoint_segments = 0
+    checkpointing_enabled = False
+    config = getattr(model, "config", None)
+    use_cache = getattr(config, "use_cache", None)
+    if grad_checkpointing:
+        if isinstance(model, nn.Sequential):
+            checkpoint_segments = min(4, len(model))
+        elif hasattr(model, "gradient_checkpointing_enable") and not getattr(model, "is_gradient_checkpointing", False):
+            model.gradient_checkpointing_enable()
+            checkpointing_enabled = True
+            if config is not None:
+                config.use_cache = False  # cached key/values are incompatible with checkpointing
+
+    # the python overhead of the forward pass dominates on small models, compiling removes most of it
+    forward_loss = _forward_loss
+    if use_compile:
+        forward_loss = torch.compile(_forward_loss, mode="reduce-overhead")
+
+    try:
+        # running training for 'epochs' number of epochs
+        for epoch in range(epochs): 
+            optim_fn.zero_grad()
+            loss = forward_loss(model, loss_fn, batch_x, batch_y, checkpoint_segments)
+            loss.backward()
+
+            # the optimizer updates the parameters in place, so the pending checks have to finish first
+            if pending_flags is not None:
+                validate_stream.synchronize()
+                _raise_on_flags(model_params, pending_flags.tolist(), **flag_limits, **flag_tests)
+                print(f"Epoch {epoch - 1}: All tests passed successfully.")
+                pending_flags = None
+
+            optim_fn.step()
+
+            # tests will be performed on the basis of the flag value passed in function call
+            # the checks are not part of training, so no autograd bookkeeping is needed for them
+            with torch.no_grad():
+                if validate_stream is not None:
+                    validate_stream.wait_stream(torch.cuda.current_stream(params_list[0].device))
+                    with torch.cuda.stream(validate_stream):
+                        flags = _batched_flags(params_list, **flag_limits, **flag_tests)
+                        host_flags.copy_(flags, non_blocking=True)
+                    pending_flags = host_flags
+                elif validate:
+                    flags = _batched_flags(params_list, **flag_limits, **flag_tests)
+                    _raise_on_flags(model_params, flags.tolist(), **flag_limits, **flag_tests)
+                if test_gradient_smaller==True:
+                    _batched_gradient_check(model_params, grad_limit=grad_limit)
         
-        print(f"Epoch {epoch}: All tests passed successfully.")
-    
+            if pending_flags is None:
+                print(f"Epoch {epoch}: All tests passed successfully.")
+
+        # the checks of the final epoch have nothing left to overlap with
+        if pending_flags is not None:
+            validate_stream.synchronize()
+            _raise_on_flags(model_params, pending_flags.tolist(), **flag_limits, **flag_tests)
+            print(f"Epoch {epochs - 1}: All tests passed successfully.")
+    finally:
+        if checkpointing_enabled:
+            if hasattr(model, "gradient_checkpointing_disable"):
+                model.gradient_checkpointing_disable()
+            if config is not None:
+                config.use_cache = use_cache
+
     # perform params change tests in the end
     if test_params_changing==True:
-        model_params_new = get_params(model)
-        check_params_changing(model_params_old, model_params_new)   
+        check_params_changing(model_params_old, model_params)
             
 
 if __name__ == "__main__":